@@ -1,12 +1,68 @@
+import concurrent.futures
 import functools
+import itertools
 import json
-from typing import FrozenSet, List, Dict, Tuple
+from typing import FrozenSet, List, Dict, Tuple, Union
 
 import numpy as np
 import stim
 import yaml
 
 HyperEdge = FrozenSet[int]
+# bit i is set iff detector i is in the hyperedge
+HyperEdgeMask = int
+# a detector mask is a cheaper dedup key, but only while it fits in a machine word
+MAX_MASK_DETECTORS = 64
+# (detectors, separator positions, dedup key, frame mask, probability) of an error
+ParsedError = Tuple[List[int], List[int], Union[HyperEdgeMask, HyperEdge], int, float]
+
+
+def _parse_error(instruction: stim.DemInstruction, use_mask: bool) -> ParsedError:
+    """Split an error instruction into detectors, separators, dedup key, frame and probability.
+
+    The dedup key is the detector bitmask if `use_mask` is set, else the detector frozenset.
+    """
+    dets_flat = []
+    sep_positions = []
+    dets_mask = 0
+    frame_mask = 0
+    sub_frame_mask = 0
+    prob = instruction.args_copy()[0]
+    for t in instruction.targets_copy():
+        if t.is_relative_detector_id():
+            dets_flat.append(t.val)
+            if use_mask:
+                dets_mask |= 1 << t.val
+        elif t.is_logical_observable_id():
+            sub_frame_mask |= 1 << t.val
+        elif t.is_separator():
+            sep_positions.append(len(dets_flat))
+            frame_mask ^= sub_frame_mask
+            sub_frame_mask = 0
+    frame_mask ^= sub_frame_mask
+    dets_key = dets_mask if use_mask else frozenset(dets_flat)
+    return dets_flat, sep_positions, dets_key, frame_mask, prob
+
+
+def _parse_dem_errors(dem: stim.DetectorErrorModel, use_mask: bool) -> List[ParsedError]:
+    """Parse all the error instructions of a flattened detector error model."""
+    parsed_errors = []
+    for instruction in dem:
+        if isinstance(instruction, stim.DemInstruction):
+            if instruction.type == "error":
+                parsed_errors.append(_parse_error(instruction, use_mask))
+            elif instruction.type == "detector":
+                pass
+            else:
+                raise NotImplementedError()
+        else:
+            raise NotImplementedError()
+    return parsed_errors
+
+
+def _parse_dem_text(dem_text: str, use_mask: bool) -> List[ParsedError]:
+    """Parse a chunk of a flattened detector error model given as text, in a worker process."""
+    return _parse_dem_errors(stim.DetectorErrorModel(dem_text), use_mask)
 
 
 class TannerGraph:
@@ -18,50 +74,80 @@ class TannerGraph:
     errors flip the same detectors are considered as the same vnode.
     """
 
-    def __init__(self, dem: stim.DetectorErrorModel) -> None:
+    def __init__(self, dem: stim.DetectorErrorModel, num_workers: int = 1) -> None:
         """Construct the tanner graph from a detector error model.
 
         Args:
             dem: The detector error model.
+            num_workers: The number of processes used to parse the error instructions.
+                Defaults to 1, which parses in the current process.
         """
         self._dem = dem.flattened()
 
-        self._hyperedges: List[HyperEdge] = []
-        self._hyperedge_frames: Dict[HyperEdge, FrozenSet[int]] = {}
-        self._hyperedge_probs: Dict[HyperEdge, float] = {}
-        self._stim_decompose: Dict[HyperEdge, List[HyperEdge]] = {}
-        self._process_dem()
-        self._tanner_matrix = self._gen_tanner_matrix()
+        self._hyperedge_offsets = np.zeros(1, dtype=np.int64)
+        self._hyperedge_dets = np.zeros(0, dtype=np.int32)
+        self._hyperedge_probs = np.zeros(0, dtype=np.float64)
+        self._hyperedge_frames = np.zeros(0, dtype=object)
+        self._stim_decompose: List[List[Tuple[int, ...]]] = []
+        self._process_dem(num_workers)
 
     @property
     def hyperedges(self) -> List[HyperEdge]:
         """All the hyperedges included in the detector error model."""
-        return self._hyperedges
+        dets = self._hyperedge_dets.tolist()
+        offsets = self._hyperedge_offsets.tolist()
+        return [frozenset(dets[lo:hi]) for lo, hi in zip(offsets, offsets[1:])]
+
+    @property
+    def hyperedge_offsets(self) -> np.ndarray:
+        """The CSR offsets of the hyperedges into `hyperedge_dets`.
+
+        The detectors of hyperedge i are `hyperedge_dets[offsets[i]:offsets[i + 1]]`.
+        The shape is (num_hyperedges + 1, ).
+        """
+        return self._hyperedge_offsets
+
+    @property
+    def hyperedge_dets(self) -> np.ndarray:
+        """The sorted detectors of all hyperedges, concatenated."""
+        return self._hyperedge_dets
 
     @property
-    def hyperedge_frames(self) -> Dict[HyperEdge, FrozenSet[int]]:
-        """The frames of all hyperedges."""
+    def hyperedge_frames(self) -> np.ndarray:
+        """The frames of all hyperedges as bitmasks of logical observables.
+
+        Bit k of entry i is set iff hyperedge i flips observable Lk. The entries are
+        Python ints (dtype=object), so observables beyond L63 are supported.
+        """
         return self._hyperedge_frames
 
     @property
-    def hyperedge_probs(self) -> Dict[HyperEdge, float]:
+    def hyperedge_probs(self) -> np.ndarray:
         """The probabilities of all hyperedges."""
         return self._hyperedge_probs
 
     @property
-    def stim_decompose(self) -> Dict[HyperEdge, List[HyperEdge]]:
-        """The stim suggested decomposition of all hyperedges."""
+    def stim_decompose(self) -> List[List[Tuple[int, ...]]]:
+        """The stim suggested decomposition of all hyperedges, as sorted detector tuples."""
         return self._stim_decompose
 
-    @property
+    @functools.cached_property
     def tanner_matrix(self) -> np.ndarray:
-        """The tanner matrix repr of the detector error model."""
-        return self._tanner_matrix
+        """The tanner matrix repr of the detector error model, built on first access."""
+        return self._gen_tanner_matrix()
+
+    @functools.cached_property
+    def tanner_matrix_packed(self) -> np.ndarray:
+        """The tanner matrix with each row bit-packed along the hyperedge axis.
+
+        The shape is (num_dets, ceil(num_hyperedges / 8)) with dtype uint8.
+        """
+        return np.packbits(self.tanner_matrix, axis=1)
 
     @property
     def num_hyperedges(self) -> int:
         """The number of hyperedges."""
-        return len(self.hyperedges)
+        return len(self._hyperedge_probs)
 
     @property
     def num_dets(self) -> int:
@@ -71,60 +157,99 @@ class TannerGraph:
     def _gen_tanner_matrix(self) -> np.ndarray:
         """Generate the tanner matrix from the hyperedges."""
         tanner_matrix = np.zeros((self.num_dets, self.num_hyperedges), dtype=np.bool_)
-        for vnode, hyperedge in enumerate(self._hyperedges):
-            for cnode in hyperedge:
-                tanner_matrix[cnode, vnode] = True
+        vnodes = np.repeat(
+            np.arange(self.num_hyperedges), np.diff(self._hyperedge_offsets)
+        )
+        tanner_matrix[self._hyperedge_dets, vnodes] = True
         return tanner_matrix
 
-    def _process_dem(self):
-        """Parse the detector error model."""
-        for instruction in self._dem:
-            if isinstance(instruction, stim.DemInstruction):
-                if instruction.type == "error":
-                    self._process_error(instruction)
-                elif instruction.type == "detector":
-                    pass
+    def _process_dem(self, num_workers: int):
+        """Parse the detector error model and merge the errors into hyperedges."""
+        # the key type must be decided for the whole DEM, not per parsed chunk
+        use_mask = self.num_dets < MAX_MASK_DETECTORS
+        hyperedge_index: Dict[Union[HyperEdgeMask, HyperEdge], int] = {}
+        hyperedges: List[List[int]] = []
+        frames: List[int] = []
+        error_rows: List[int] = []
+        error_probs: List[float] = []
+        if num_workers > 1:
+            chunk_size = max(1, -(-len(self._dem) // num_workers))
+            chunks = [
+                str(self._dem[start:start + chunk_size])
+                for start in range(0, len(self._dem), chunk_size)
+            ]
+            with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers) as executor:
+                parsed_errors = list(itertools.chain.from_iterable(
+                    executor.map(_parse_dem_text, chunks, itertools.repeat(use_mask))
+                ))
+        else:
+            parsed_errors = _parse_dem_errors(self._dem, use_mask)
+
+        for dets_flat, sep_positions, dets_key, frame_mask, prob in parsed_errors:
+            index = hyperedge_index.get(dets_key)
+            if index is None:
+                index = hyperedge_index[dets_key] = len(hyperedges)
+                hyperedges.append(sorted(set(dets_flat)))
+                frames.append(frame_mask)
+                # the per-component split is only materialized for new hyperedges
+                if sep_positions:
+                    bounds = [0, *sep_positions, len(dets_flat)]
+                    dets_track = [dets_flat[lo:hi] for lo, hi in zip(bounds, bounds[1:])]
                 else:
-                    raise NotImplementedError()
-            else:
-                raise NotImplementedError()
+                    dets_track = [dets_flat]
+                self._stim_decompose.append([tuple(sorted(d)) for d in dets_track])
+            error_rows.append(index)
+            error_probs.append(prob)
 
-    def _process_error(self, instruction: stim.DemInstruction):
-        dets_track = []
-        frames_track = []
-        dets_sep_track = []
-        frames_sep_track = []
-        prob = instruction.args_copy()[0]
-        for t in instruction.targets_copy():
-            if t.is_relative_detector_id():
-                dets_sep_track.append(t.val)
-            elif t.is_logical_observable_id():
-                frames_sep_track.append(t.val)
-            elif t.is_separator():
-                dets_track.append(dets_sep_track)
-                frames_track.append(frames_sep_track)
-                dets_sep_track = []
-                frames_sep_track = []
-        dets_track.append(dets_sep_track)
-        frames_track.append(frames_sep_track)
-        dets = frozenset(i for dets in dets_track for i in dets)
-        frame = frozenset(functools.reduce(
-            lambda x, y: x.symmetric_difference(y),
-            [set(frame) for frame in frames_track],
-            set()
-        ))
-        if dets not in self._hyperedges:
-            self._hyperedges.append(dets)
-            self._hyperedge_probs[dets] = prob
-            self._hyperedge_frames[dets] = frame
-            self._stim_decompose[dets] = [
-                frozenset(dets)
-                for dets, frame in zip(dets_track, frames_track)
-            ]
+        lengths = np.fromiter(
+            (len(h) for h in hyperedges), dtype=np.int64, count=len(hyperedges)
+        )
+        self._hyperedge_offsets = np.concatenate(([0], np.cumsum(lengths)))
+        self._hyperedge_dets = np.fromiter(
+            itertools.chain.from_iterable(hyperedges),
+            dtype=np.int32,
+            count=int(self._hyperedge_offsets[-1]),
+        )
+        rows = np.array(error_rows, dtype=np.intp)
+        probs = np.array(error_probs, dtype=np.float64)
+        # independent errors on the same hyperedge combine by XOR:
+        # 1 - 2p = prod(1 - 2p_i), summed as log1p terms to keep small p accurate
+        if np.all(probs < 0.5):
+            log_parity = np.zeros(len(hyperedges), dtype=np.float64)
+            np.add.at(log_parity, rows, np.log1p(-2 * probs))
+            combined = -np.expm1(log_parity) / 2
         else:
-            prob_prev = self._hyperedge_probs[dets]
-            new_prob = prob_prev * (1 - prob) + prob * (1 - prob_prev)
-            self._hyperedge_probs[dets] = new_prob
+            flip_parity = np.ones(len(hyperedges), dtype=np.float64)
+            np.multiply.at(flip_parity, rows, 1 - 2 * probs)
+            combined = (1 - flip_parity) / 2
+        # hyperedges from a single error keep the DEM probability exactly
+        single = np.zeros(len(hyperedges), dtype=np.float64)
+        single[rows] = probs
+        counts = np.bincount(rows, minlength=len(hyperedges))
+        self._hyperedge_probs = np.where(counts == 1, single, combined)
+        self._hyperedge_frames = np.array(frames, dtype=object)
+
+
+def condensed_index(i: np.ndarray, j: np.ndarray, num_dets: int) -> np.ndarray:
+    """The index of the detector pairs (i, j) with i < j in the condensed upper triangle."""
+    return i * num_dets - i * (i + 1) // 2 + (j - i - 1)
+
+
+def squareform(condensed: np.ndarray, num_dets: int) -> np.ndarray:
+    """Expand a condensed upper-triangular vector into a dense symmetric matrix.
+
+    Args:
+        condensed: The pair values of length num_dets * (num_dets - 1) / 2.
+        num_dets: The number of detectors.
+
+    Returns:
+        The symmetric matrix with zero diagonal. The shape is (num_dets, num_dets).
+    """
+    dense = np.zeros((num_dets, num_dets), dtype=condensed.dtype)
+    ii, jj = np.triu_indices(num_dets, k=1)
+    dense[ii, jj] = condensed
+    dense[jj, ii] = condensed
+    return dense
 
 
 def correlation_from_detector_error_model(
@@ -136,25 +261,60 @@ def correlation_from_detector_error_model(
         dem: The detector error model to be converted.
 
     Returns:
-        edges: The correlation probability matrix of two detectors.
-            The shape is (num_dets, num_dets).
         boundary: The correlation probability matrix of a single detector with virtual boundary.
             The shape is (num_dets, ).
+        edges: The correlation probability of two detectors i < j, stored as a condensed
+            upper triangle indexed by `condensed_index`. The shape is
+            (num_dets * (num_dets - 1) / 2, ). Use `squareform` for the dense matrix.
     """
     tanner_graph = TannerGraph(dem)
-    hyperedge_probs = tanner_graph.hyperedge_probs
     num_dets = dem.num_detectors
+    hyperedge_probs = tanner_graph.hyperedge_probs
+    hyperedge_dets = tanner_graph.hyperedge_dets.astype(np.int64)
+    starts = tanner_graph.hyperedge_offsets[:-1]
+    lengths = np.diff(tanner_graph.hyperedge_offsets)
+    is_bdy = lengths == 1
+    is_edge = lengths == 2
 
-    correlation_edges = np.zeros((num_dets, num_dets))
+    correlation_edges = np.zeros(num_dets * (num_dets - 1) // 2)
     correlation_bdy = np.zeros(num_dets)
-    for i in range(num_dets):
-        correlation_bdy[i] = hyperedge_probs.get(frozenset([i]), 0.0)
-        for j in range(i):
-            pij = hyperedge_probs.get(frozenset([i, j]), 0.0)
-            correlation_edges[i, j] = correlation_edges[j, i] = pij
+    correlation_bdy[hyperedge_dets[starts[is_bdy]]] = hyperedge_probs[is_bdy]
+    # the detectors of each hyperedge are sorted, so ii < jj
+    ii = hyperedge_dets[starts[is_edge]]
+    jj = hyperedge_dets[starts[is_edge] + 1]
+    correlation_edges[condensed_index(ii, jj, num_dets)] = hyperedge_probs[is_edge]
     return correlation_bdy, correlation_edges
 
 
+def write_detector_samples(
+        circuit: stim.Circuit,
+        shots: int,
+        folder: str,
+        chunk_size: int = 10000,
+) -> None:
+    """Sample the detectors of a circuit and save them in both b8 and 01 formats.
+
+    Args:
+        circuit: The circuit to sample from.
+        shots: The number of shots to sample.
+        folder: The directory to write `detectors.b8` and `detectors.01` into.
+        chunk_size: The number of shots sampled and written at a time.
+    """
+    num_dets = circuit.num_detectors
+    sampler = circuit.compile_detector_sampler()
+    with open(f"{folder}/detectors.b8", "wb") as f_b8, \
+            open(f"{folder}/detectors.01", "wb") as f_01:
+        for start in range(0, shots, chunk_size):
+            num_shots = min(chunk_size, shots - start)
+            # bit-packed samples are already in the b8 layout
+            dets = sampler.sample(shots=num_shots, bit_packed=True)
+            f_b8.write(dets.tobytes())
+            bits = np.unpackbits(dets, axis=1, count=num_dets, bitorder='little')
+            text = np.full((num_shots, num_dets + 1), ord('\n'), dtype=np.uint8)
+            text[:, :-1] = bits + ord('0')
+            f_01.write(text.tobytes())
+
+
 def surface_code():
     code = "surface_code:rotated_memory_z"
     distance = 3
@@ -169,20 +329,7 @@ def surface_code():
         before_measure_flip_probability=0.01,
         before_round_data_depolarization=0.01,
     )
-    sampler = circuit.compile_detector_sampler()
-    dets = sampler.sample(shots=shots, bit_packed=False)
-    stim.write_shot_data_file(
-        data=dets,
-        path="surface_code/detectors.b8",
-        format='b8',
-        num_detectors=circuit.num_detectors,
-    )
-    stim.write_shot_data_file(
-        data=dets,
-        path="surface_code/detectors.01",
-        format='01',
-        num_detectors=circuit.num_detectors,
-    )
+    write_detector_samples(circuit, shots, "surface_code")
     metadata = {
         "code": code,
         "distance": distance,
@@ -197,11 +344,11 @@ def surface_code():
     dem = circuit.detector_error_model()
     graph = TannerGraph(dem)
     save_obj = {
-        "hyperedges": [list(h) for h in graph.hyperedge_probs.keys()],
-        "probability": list(graph.hyperedge_probs.values()),
+        "hyperedges": [list(h) for h in graph.hyperedges],
+        "probability": graph.hyperedge_probs.tolist(),
     }
     with open("surface_code/hyperedges.json", "w") as f:
-        json.dump(save_obj, f, indent=2)
+        json.dump(save_obj, f, separators=(',', ':'))
 
 
 def rep_code():
@@ -218,20 +365,7 @@ def rep_code():
         before_measure_flip_probability=0.01,
         before_round_data_depolarization=0.01,
     )
-    sampler = circuit.compile_detector_sampler()
-    dets = sampler.sample(shots=shots, bit_packed=False)
-    stim.write_shot_data_file(
-        data=dets,
-        path="rep_code/detectors.b8",
-        format='b8',
-        num_detectors=circuit.num_detectors,
-    )
-    stim.write_shot_data_file(
-        data=dets,
-        path="rep_code/detectors.01",
-        format='01',
-        num_detectors=circuit.num_detectors,
-    )
+    write_detector_samples(circuit, shots, "rep_code")
     metadata = {
         "code": code,
         "distance": distance,
@@ -0,0 +1,50 @@
+import json
+import os
+
+import pytest
+
+np = pytest.importorskip("numpy")
+stim = pytest.importorskip("stim")
+pytest.importorskip("yaml")
+
+from gen_data import TannerGraph
+
+DATA_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+@pytest.mark.parametrize("prob", [1e-17, 1e-9, 0.01, 0.3, 0.5, 0.75])
+def test_single_error_keeps_dem_probability(prob):
+    dem = stim.DetectorErrorModel(f"error({prob!r}) D0 D1\nerror(0.1) D2")
+    graph = TannerGraph(dem)
+    assert graph.hyperedge_probs[0] == prob
+    assert graph.hyperedge_probs[1] == 0.1
+
+
+def test_duplicate_errors_combine_by_xor():
+    dem = stim.DetectorErrorModel("error(1e-17) D0\nerror(1e-17) D0\nerror(0.1) D1\nerror(0.2) D1")
+    graph = TannerGraph(dem)
+    assert graph.hyperedge_probs[0] == pytest.approx(2e-17, rel=1e-12)
+    assert graph.hyperedge_probs[1] == pytest.approx(0.1 * 0.8 + 0.2 * 0.9, rel=1e-12)
+
+    dem = stim.DetectorErrorModel("error(0.6) D0\nerror(0.1) D0")
+    assert TannerGraph(dem).hyperedge_probs[0] == pytest.approx(0.6 * 0.9 + 0.1 * 0.4, rel=1e-12)
+
+
+def test_surface_code_hyperedges_match_committed_file():
+    circuit = stim.Circuit.generated(
+        "surface_code:rotated_memory_z",
+        distance=3,
+        rounds=2,
+        after_clifford_depolarization=0.01,
+        after_reset_flip_probability=0.01,
+        before_measure_flip_probability=0.01,
+        before_round_data_depolarization=0.01,
+    )
+    graph = TannerGraph(circuit.detector_error_model())
+    with open(os.path.join(DATA_DIR, "surface_code", "hyperedges.json")) as f:
+        saved = json.load(f)
+    expected = {
+        frozenset(h): p for h, p in zip(saved["hyperedges"], saved["probability"])
+    }
+    actual = dict(zip(graph.hyperedges, graph.hyperedge_probs.tolist()))
+    assert actual == expected